@@ -4,7 +4,9 @@ from app_core import *
 from zmq_msg_metrics import MetricsMessage, ControlMessage
 from metrics import Host, UptimeCollector, MeminfoCollector, CPUPercentCollector
 from logging_settings import *
-from datetime import datetime, timedelta
+from functools import partial
+import socket
+import time
 
 # This file defines an agent, which is designed to run on a monitored Linux system, and will report metrics to a
 # remote collector.
@@ -20,7 +22,8 @@ from datetime import datetime, timedelta
 
 # After this initial message exchange, the agent sends back system metrics every 5 seconds (this frequency is
 # configurable.) These metrics are dynamic in nature so they will be reported periodically. This information is referred
-# to as "metrics data".
+# to as "metrics data". To save bandwidth, only every tenth metrics message contains all our metrics; the "delta"
+# messages in between only contain the metrics that have changed since they were last sent.
 
 # The agent will expect to receive a "ping" ControlMessage from the collector within 30 seconds of having received the
 # initial "model" message, and will expect to continue to receive these "ping" messages at least every 30 seconds.
@@ -49,49 +52,77 @@ class AgentDealerConnection(DealerConnection):
 		                          app=app,
 		                          keyname="agent",
 		                          remote_keyname="collector",
-		                          endpoint="tcp://%s:5556" % collector_host
+		                          endpoint="tcp://%s:5556" % resolve_host(collector_host, 5556)
 		                          )
 
 	def setup(self):
+		# ControlMessage handlers, keyed by the raw message frame, so we never need to decode the message to act on it:
+		self.dispatch = {
+			b"model": self.on_model,
+			b"ping": self.on_ping
+		}
 		self.client.on_recv(self.on_recv)
 
 	def on_recv(self, msg):
-		self.app.last_collector_msg_on = datetime.utcnow()
-		if msg[0] == ControlMessage.header:
-			msg_obj = ControlMessage.from_msg(msg)
-			if msg_obj.message == "model":
-				if self.app.received_model_request is None or (
-						self.app.received_model_request is not None and datetime.now() -
-						self.app.received_model_request > timedelta(seconds=5)
-				):
-					self.app.received_model_request = datetime.now()
-					self.app.send_msg(metrics_type='model')
-				if not self.app.periodic_metrics.is_running():
-					self.app.periodic_metrics.start()
-				return
+		self.app.last_collector_msg_on = self.app.io_loop.time()
+		self.app.reconnect_backoff_s = self.app.min_reconnect_backoff_s
+		if len(msg) == 2 and msg[0] == ControlMessage.header:
+			handler = self.dispatch.get(msg[1])
+			if handler is not None:
+				handler(msg)
 			else:
-				logging.info("Received %s message from collector." % msg_obj.message)
-				return
+				logging.info("Received %s message from collector.", msg[1].decode("utf-8", "replace"))
+			return
 		logging.warning("Received unknown message from collector.")
 
+	def on_model(self, msg):
+		now = self.app.last_collector_msg_on
+		if self.app.received_model_request is None or now - self.app.received_model_request > 5:
+			self.app.received_model_request = now
+			self.app.send_msg(metrics_type='model')
+		if self.app.next_metrics_on is None:
+			self.app.next_metrics_on = now
+
+	def on_ping(self, msg):
+		# on_recv() has already recorded that we heard from the collector, which is all a ping is for.
+		pass
+
 
 class AppAgent(object):
 
 	"""The AppAgent is the main python class that wraps our agent application. It is configured to report metrics
 	back to the collector every metrics_interval_ms seconds (15000 by default, configurable below.) The AppAgent defines
-	a periodic task to make this happen. It also defines the helper send_msg() method which is used internally by
-	AppAgent as well as by the AgentDealerConnection to reply to 'model this hostname' messages."""
+	a single periodic task, run every tick_interval_ms, which both sends metrics when they are due and checks whether
+	our connection to the collector has gone stale. It also defines the helper send_msg() method which is used
+	internally by AppAgent as well as by the AgentDealerConnection to reply to 'model this hostname' messages."""
 
+	tick_interval_ms = 1000
+	# something due within half a tick of now is treated as due, so that tick jitter doesn't make us skip a whole tick:
+	tick_slack_s = tick_interval_ms / 2000
 	metrics_interval_ms = 1000
+	metrics_interval_s = metrics_interval_ms / 1000
 	stale_interval_ms = 10000
-	stale_interval_timedelta = timedelta(seconds=stale_interval_ms//1000)
+	stale_interval_s = stale_interval_ms / 1000
+	min_reconnect_backoff_s = 0.1
+	max_reconnect_backoff_s = 30
+	# Every keyframe_interval'th metrics message carries our full grid; the ones in between only carry the metrics that
+	# have changed since we last sent them -- by more than delta_thresholds[key], if given:
+	keyframe_interval = 10
+	delta_thresholds = {"cpu.percent": 50} # cpu.percent is in hundredths of a percent, so this is 0.5%
+	# A delta with nothing in it isn't sent -- unless we've sent the collector nothing for heartbeat_interval_s, in
+	# which case we send it anyway, since our metrics messages are the only way the collector knows we're still here.
+	# This must stay well under the collector's stale_interval (AppCollector.stale_interval, 30s), or an idle host
+	# would be expired by the collector. (Keyframes alone aren't enough: they come every keyframe_interval *
+	# metrics_interval_s, which could be longer.)
+	heartbeat_interval_s = 10.0
+	hello_frames = ControlMessage("hello").to_frames()
 
 	def __init__(self):
 
 		self.collector_host = None
 		self.collector_conn = None
-		self.periodic_stale = None
-		self.periodic_metrics = None
+		self.io_loop = IOLoop.current()
+		self.periodic = None
 		self.received_model_request = None
 
 		# agent metrics initialization:
@@ -99,45 +130,125 @@ class AppAgent(object):
 		self.localhost = Host()
 		self.collectors = [UptimeCollector(), MeminfoCollector(), CPUPercentCollector()]
 
+		# For each metrics type, the (collector, sampler) pairs for the collectors that provide metrics of that type,
+		# with the metrics type already bound to each sampler. This way, asking for model data doesn't sample
+		# collectors (like the CPU collector, whose readings are deltas) that have no model data to give.
+
+		self.samplers = dict(
+			(metrics_type, [(col, partial(col.get_samples, metrics_type=metrics_type))
+			                for col in self.collectors if metrics_type in col.metric_defs])
+			for metrics_type in ("metrics", "model")
+		)
+
+		# Each collector is only sampled for metrics data every interval_ms; in between, the last values it gave us are
+		# sent again. This records when each collector is next due:
+
+		self.next_sample_on = dict((col, 0.0) for col in self.collectors)
+
+		# We only ever talk to a single collector, so we allocate our outgoing messages (and the grids they wrap) once
+		# and refill them in place on every send, rather than building new ones each tick.
+
+		self._grids = {"metrics": {}, "delta": {}, "model": {}}
+		self._msgs = dict(
+			(metrics_type, MetricsMessage(self.localhost.hostname, grid, metrics_type=metrics_type))
+			for metrics_type, grid in self._grids.items()
+		)
+
 		# These properties are used to track when we have last heard from the collector, and whether we should send
-		# data back.
+		# data back. Times are in the ioloop's time base (see io_loop.time()). next_metrics_on is None until the
+		# collector has asked us for model data, which is our cue to start sending metrics.
 
 		self.last_collector_msg_on = None
+		self.hello_sent_on = None
+		self.next_metrics_on = None
+
+		# How long to wait before saying hello again after our connection goes stale. This doubles with each stale
+		# connection, and is reset whenever we hear from the collector:
+
+		self.reconnect_backoff_s = self.min_reconnect_backoff_s
+
+		# The metrics values the collector has most recently been sent, for computing deltas:
+
+		self.last_sent = {}
+		self.metrics_since_keyframe = self.keyframe_interval
+
+		# When we last sent the collector a metrics message of any type, in the ioloop's time base:
+
+		self.metrics_sent_on = 0.0
 
 	def setup_collector_connection(self, collector_host):
 
 		self.collector_host = collector_host
 		self.collector_conn = AgentDealerConnection(app=self, collector_host=self.collector_host)
-		self.periodic_metrics = PeriodicCallback(self.periodictask_send_metrics, self.metrics_interval_ms)
-		self.periodic_stale = PeriodicCallback(self.periodictask_stale_connection, self.stale_interval_ms)
+		self.periodic = PeriodicCallback(self.periodictask, self.tick_interval_ms)
 
-	def periodictask_send_metrics(self):
-		if self.received_model_request:
+	def periodictask(self):
+
+		now = self.io_loop.time()
+
+		# The collector counts as heard from when we said hello, so that a fresh connection gets a full stale interval
+		# to respond:
+
+		if now - max(self.last_collector_msg_on or 0.0, self.hello_sent_on) > self.stale_interval_s:
+			logging.warning("No response from collector, no longer sending metrics.")
+			self.stop()
+			return
+
+		if self.next_metrics_on is not None and now + self.tick_slack_s >= self.next_metrics_on:
+			self.next_metrics_on = next_deadline(self.next_metrics_on, self.metrics_interval_s, now)
 			self.send_msg()
 
 	def send_msg(self, metrics_type='metrics'):
 
 		"""collect metrics and send them back to the collector"""
 
-		grid = {}
-		for col in self.collectors:
-			grid.update(col.get_samples(metrics_type=metrics_type))
-		msg = MetricsMessage(self.localhost.hostname, grid, metrics_type=metrics_type)
-		sys.stdout.write("M" if metrics_type == "model" else "m")
-		sys.stdout.flush()
-		msg.send(self.collector_conn.client)
-
-	def periodictask_stale_connection(self):
-		if self.last_collector_msg_on is None or datetime.utcnow() - self.last_collector_msg_on > self.stale_interval_timedelta:
-			logging.warning("No response from collector, no longer sending metrics.")
-			self.stop()
+		grid = self._grids[metrics_type]
+		if metrics_type == "metrics":
+			now = self.io_loop.time()
+			for col, sampler in self.samplers["metrics"]:
+				if now + self.tick_slack_s >= self.next_sample_on[col]:
+					self.next_sample_on[col] = next_deadline(self.next_sample_on[col], col.interval_ms / 1000, now)
+					grid.update(sampler())
+			if self.metrics_since_keyframe >= self.keyframe_interval:
+				# the keyframe itself counts, so that the next one is keyframe_interval messages after this one:
+				self.metrics_since_keyframe = 1
+				self.last_sent.update(grid)
+			else:
+				self.metrics_since_keyframe += 1
+				metrics_type = "delta"
+				grid = self.delta(grid)
+				if not grid and now - self.metrics_sent_on < self.heartbeat_interval_s:
+					return
+		else:
+			grid.clear()
+			for col, sampler in self.samplers[metrics_type]:
+				grid.update(sampler())
+		msg = self._msgs[metrics_type]
+		msg.changed()
+		logging.debug("Sending %s data to collector.", metrics_type)
+		send_now(self.collector_conn.client, msg.to_frames(), copy=msg.copy_frames)
+		self.metrics_sent_on = self.io_loop.time()
+
+	def delta(self, grid):
+
+		"""Fill our pooled 'delta' grid with the metrics in grid that have changed since we last sent them, and return
+		it."""
+
+		delta = self._grids["delta"]
+		delta.clear()
+		last_sent = self.last_sent
+		for key, value in grid.items():
+			if key not in last_sent or abs(value - last_sent[key]) > self.delta_thresholds.get(key, 0):
+				delta[key] = value
+		last_sent.update(delta)
+		return delta
 
 	def stop(self):
 		logging.debug("Stopping IOLoop.")
-		if self.periodic_metrics.is_running():
-			self.periodic_metrics.stop()
-		if self.periodic_stale.is_running():
-			self.periodic_stale.stop()
+		self.next_metrics_on = None
+		self.metrics_since_keyframe = self.keyframe_interval
+		if self.periodic.is_running():
+			self.periodic.stop()
 		stop_ioloop()
 
 
@@ -149,22 +260,53 @@ class AppAgent(object):
 
 		while True:
 
-			# Attempt to connect and send "hello" to the collector...
-			sys.stdout.write("h")
-			sys.stdout.flush()
-			ControlMessage("hello").send(self.collector_conn.client)
+			# Attempt to connect and send "hello" to the collector. We are not inside the ioloop at this point, so we
+			# send directly on the underlying socket if we can, rather than waiting for the ioloop to start...
+			logging.debug("Sending hello to collector.")
+			send_now(self.collector_conn.client, self.hello_frames, copy=False)
+			self.hello_sent_on = self.io_loop.time()
 
-			# We want to now start a periodic task to check every 30 seconds whether we have heard from the collector.
-			# Otherwise, we will consider our connection the the collector to be stale.
+			# We want to now start our periodic task, which will check whether we have heard from the collector
+			# recently. Otherwise, we will consider our connection the the collector to be stale.
 
-			if not self.periodic_stale.is_running():
-				self.periodic_stale.start()
+			if not self.periodic.is_running():
+				self.periodic.start()
 
 			# If the connection to the collector becomes stale, self.stop() will be called which will stop all active
 			# periodic tasks and cause start_ioloop() to return.
 
 			start_ioloop()
 
+			# Don't hammer a collector that has gone away -- back off before saying hello again:
+
+			time.sleep(self.reconnect_backoff_s)
+			self.reconnect_backoff_s = min(self.reconnect_backoff_s * 2, self.max_reconnect_backoff_s)
+			self.collector_conn.reconnect()
+
+
+def resolve_host(hostname, port):
+
+	"""Resolve hostname to an IPv4 address (the only kind libzmq connects to by default) once, up front, so that it
+	isn't looked up again every time we reconnect. If it can't be resolved, hostname is returned unchanged and libzmq
+	will keep trying to resolve it itself."""
+
+	try:
+		return socket.getaddrinfo(hostname, port, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+	except socket.gaierror as e:
+		logging.warning("Couldn't resolve %s (%s); connecting by name.", hostname, e)
+		return hostname
+
+
+def next_deadline(deadline, interval, now):
+
+	"""Advance a periodic deadline by interval, keeping a fixed cadence even if the tick that hit it ran a little late.
+	(Rescheduling from 'now' would make a slightly-late tick push the next deadline past the following tick.) If we have
+	fallen more than a whole interval behind, the cadence restarts from now."""
+
+	deadline += interval
+	return deadline if deadline > now else now + interval
+
+
 if __name__ == "__main__":
 	# Start agent:
 	if len(sys.argv) != 2:
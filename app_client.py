@@ -1,21 +1,44 @@
 #! /usr/bin/python3
 
 from app_core import *
-from zmq_msg_metrics import MetricsMessage, ControlMessage
+from zmq_msg_metrics import MetricsMessage, MetricsBatchMessage
 import curses
-from datetime import datetime
+import time
+from operator import itemgetter
 
+# the memory metrics that together make up total memory, with mem.avail first:
+mem_keys = ("mem.avail", "mem.free", "mem.buffers", "mem.cached")
+mem_metrics = itemgetter(*mem_keys)
 
-class ClientDealerConnection(DealerConnection):
+# curses.color_pair() attributes for each color pair number, filled in by main() once the pairs are initialized:
+color_attrs = []
+
+
+class ClientSubscriberConnection(DealerConnection):
+
+	"""The collector publishes metrics to all of its clients at once, so we connect to it with a SUB socket and
+	subscribe to everything."""
 
 	def __init__(self, app, collector_host):
-		DealerConnection.__init__(self, app=app, keyname="client", remote_keyname="collector", endpoint="tcp://%s:5557" % collector_host )
+		DealerConnection.__init__(self,
+		                          app=app,
+		                          keyname="client",
+		                          remote_keyname="collector",
+		                          endpoint="tcp://%s:5557" % collector_host,
+		                          socket_type=zmq.SUB
+		                          )
 
 	def setup(self):
+		self.client.socket.setsockopt(zmq.SUBSCRIBE, b"")
 		self.client.on_recv(self.on_recv)
 
 	def on_recv(self, msg):
-		if msg[0] == MetricsMessage.header:
+		if msg[0] == MetricsBatchMessage.header:
+			batch = MetricsBatchMessage.from_msg(msg)
+			if batch is not None:
+				for msg_obj in batch.messages:
+					self.app.update_metrics_data(msg_obj)
+		elif msg[0] == MetricsMessage.header:
 			msg_obj = MetricsMessage.from_msg(msg)
 			self.app.update_metrics_data(msg_obj)
 
@@ -23,42 +46,63 @@ class ClientDealerConnection(DealerConnection):
 class AppClient(object):
 
 	screen_interval_ms = 1000
-	hello_interval_ms = 15000
 
 	def __init__(self, collector_host, stdscr):
-		self.client_conn = ClientDealerConnection(self, collector_host)
+		self.client_conn = ClientSubscriberConnection(self, collector_host)
 		self.screen_periodic = PeriodicCallback(self.screen_periodictask, self.screen_interval_ms)
-		self.hello_periodic = PeriodicCallback(self.send_hello, self.hello_interval_ms)
 		self.stdscr = stdscr
 		self.hostnames = [] # ordered list of hostnames for display
+		self.row_buf = bytearray(curses.COLS) # reused to render each utilization bar
+		self.clock_shown = None # the second currently displayed by our clock
+		self.grids = {} # everything we know about each hostname, merged from all the metrics messages we've received
 
 	def update_metrics_data(self, metrics_msg):
-		if metrics_msg.hostname not in self.hostnames:
-			self.hostnames.append(metrics_msg.hostname)
+
+		# Agents send "delta" messages containing only the metrics that have changed, as well as full "metrics" and
+		# "model" messages, so we merge every message into the host's grid. We then only redraw the parts of the host's
+		# display whose inputs have changed. Nothing is refreshed here -- screen_periodictask() pushes all pending
+		# changes to the terminal once a second.
+
+		grid = self.grids.get(metrics_msg.hostname)
+		first = grid is None
+		if first:
+			grid = self.grids[metrics_msg.hostname] = {}
+			if metrics_msg.hostname not in self.hostnames:
+				self.hostnames.append(metrics_msg.hostname)
+		changed = dict((k, v) for k, v in metrics_msg.grid_dict.items() if k not in grid or grid[k] != v)
+		if not changed and not first:
+			return
+		grid.update(changed)
 		screen_pos = self.hostnames.index(metrics_msg.hostname)
-		
-		curses_write(self.stdscr, 0, screen_pos * 5 + 1, metrics_msg.hostname)
-		curses_write(self.stdscr, 0, screen_pos * 5 + 2, repr(metrics_msg.grid_dict))
-		avail_mem = metrics_msg.grid_dict["mem.avail"]
-		total_mem = metrics_msg.grid_dict["mem.avail"] + metrics_msg.grid_dict["mem.free"] + metrics_msg.grid_dict["mem.buffers"] + metrics_msg.grid_dict["mem.cached"]
-		utilization_bar(self.stdscr, screen_pos * 5 + 3, "mem", avail_mem, total_mem, color=12)
-		utilization_bar(self.stdscr, screen_pos * 5 + 4, "cpu", int(metrics_msg.grid_dict["cpu.percent"] * 100), 100)
-		self.stdscr.refresh()
+
+		if first:
+			curses_write(self.stdscr, 0, screen_pos * 5 + 1, metrics_msg.hostname_bytes)
+		curses_write(self.stdscr, 0, screen_pos * 5 + 2, repr(grid))
+		if not changed.keys().isdisjoint(mem_keys):
+			try:
+				mem = mem_metrics(grid)
+			except KeyError:
+				# we haven't received all of this host's memory metrics yet.
+				pass
+			else:
+				avail_mem = mem[0]
+				total_mem = sum(mem)
+				utilization_bar(self.stdscr, self.row_buf, screen_pos * 5 + 3, b"mem", avail_mem, total_mem, color=12)
+		if "cpu.percent" in changed:
+			# cpu.percent arrives in hundredths of a percent:
+			utilization_bar(self.stdscr, self.row_buf, screen_pos * 5 + 4, b"cpu", grid["cpu.percent"], 10000)
 
 	def screen_periodictask(self):
-		curses_write(self.stdscr, 0, 0, repr(datetime.now()))
+		now = int(time.time())
+		if now != self.clock_shown:
+			self.clock_shown = now
+			curses_write(self.stdscr, 0, 0, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
 		self.stdscr.refresh()
 
-	def send_hello(self):
-		msg_obj = ControlMessage('hello')
-		msg_obj.send(self.client_conn.client)
-
 	def start(self):
 		self.stdscr.clear()
 		self.stdscr.refresh()
 		self.screen_periodic.start()
-		self.hello_periodic.start()
-		self.send_hello()
 		start_ioloop()
 
 
@@ -70,14 +114,17 @@ def curses_write(stdscr, x, y, output, color=0):
 	to_trunc = (x + len(output)) - curses.COLS
 	if to_trunc > 0:
 		output = output[:-to_trunc]
-	stdscr.addstr(y, x, output, curses.color_pair(color))
+	stdscr.addstr(y, x, output, color_attrs[color])
 
 
-def utilization_bar(stdscr, y, label, stat, scale, color=11):
-	bar_length = curses.COLS * (stat / scale)
-	outstr = "=" * int(bar_length) + " " * (curses.COLS - int(bar_length))
-	curses_write(stdscr, 0, y, label + " ")
-	curses_write(stdscr, len(label) + 1, y, outstr[len(label)+1:], color)
+def utilization_bar(stdscr, row_buf, y, label, stat, scale, color=11):
+	# The whole row -- label and bar -- is rendered into row_buf and written with a single addstr:
+	cols = len(row_buf)
+	bar_length = max(0, min(int(cols * (stat / scale)), cols))
+	row_buf[:bar_length] = b"=" * bar_length
+	row_buf[bar_length:] = b" " * (cols - bar_length)
+	row_buf[:len(label) + 1] = label + b" "
+	curses_write(stdscr, 0, y, bytes(row_buf), color)
 
 
 def main(stdscr):
@@ -85,6 +132,9 @@ def main(stdscr):
 	curses.use_default_colors()
 	for i in range(0, curses.COLORS):
 		curses.init_pair(i + 1, i, -1)
+	# Our utilization bars use pairs 11 and 12 whatever the terminal supports, so the table always covers them. (On
+	# terminals with fewer colors, those pairs are left uninitialized and draw in the default colors.)
+	color_attrs[:] = [curses.color_pair(i) for i in range(max(curses.COLORS, 12) + 1)]
 	agent = AppClient(sys.argv[1], stdscr)
 	agent.start()
 
@@ -1,16 +1,17 @@
 #! /usr/bin/python3
 
 from app_core import *
-from zmq_msg_metrics import MetricsMessage, ControlMessage
-from datetime import datetime, timedelta
+from zmq_msg_metrics import MetricsMessage, ControlMessage, MetricsBatchMessage
+import heapq
+import time
 from logging_settings import *
 
 # This file defines a collector, which is designed to accept connections from both agents (which are relaying back
 # metrics data from monitored systems) and clients (who will be sent metrics data to be displayed in real-time by the
 # system administrator, or possibly recorded to a database for later querying.)
 
-# Because the collector allows connections from agents as well as clients, it has two ROUTER connections -- one for
-# agents, and another for clients. These connections have different security policies. We accept metrics from any
+# Because the collector allows connections from agents as well as clients, it has two listening sockets -- a ROUTER for
+# agents, and an XPUB for clients. These connections have different security policies. We accept metrics from any
 # agent that connects to us, but we use ZAP to only allow authorized clients to connect, since we want to be able to
 # connect to the collector as a client from anywhere on the Internet, and we consider our metrics data to be
 # restricted and want to protect it from prying eyes.
@@ -35,246 +36,302 @@ from logging_settings import *
 
 # CLIENT CONNECTION - for receiving forwarded metrics from all hosts
 
-# When a client connects, we expect to immediately receive an initial "hello" ControlMessage from it. After receiving
-# this message, we will immediately reply with a list of hosts and their infrequently-changing attributes -- our "model
-# data." After this initial exchange, we will forward metric data to the client(s) asynchronously, as we receive it from
-# each agent, as well as model data for new agents that connect. We also know that each client expects to hear from the
-# collector at least every 30 seconds. So every 15 seconds, we will send a "ping" ControlMessage to each client. These
-# messages are sent asynchonously and are not tied to one another in any kind of request/reply pattern.
+# Clients connect to us with a SUB socket, and we publish to all of them at once through our XPUB socket, so that
+# relaying a message to every client is a single send -- ZeroMQ takes care of the fan-out. When a client connects and
+# subscribes, XPUB tells us about the new subscription, and we immediately publish our list of hosts and their
+# infrequently-changing attributes -- our "model data." (Clients that already have this data will simply receive it
+# again.) After this, we will publish metric data asynchronously, as we receive it from each agent, as well as model
+# data for new agents that connect. To keep per-message overhead down, the metrics messages we receive from agents are
+# relayed in batches (a MetricsBatchMessage), which we publish once we have relay_batch_size of them, or relay_delay_s
+# after the first one arrived. We also know that each client expects to hear from the collector at least every 30
+# seconds, so if we haven't published anything for 20 seconds, we will publish a "ping" ControlMessage. ZeroMQ drops
+# subscribers that disconnect, so we don't need to track clients ourselves.
 
 class CollectorMetricRouterListener(RouterListener):
 
+	model_frames = ControlMessage("model").to_frames()
+	drain_limit = 1000
+	touch_interval = 1.0 # seconds
+
 	def __init__(self, app, listen_ip):
 		RouterListener.__init__(self, app=app, keyname="collector", bind_addr="tcp://%s:5556" % listen_ip, zap_auth=False)
 		self.identities = {}
 		self.hostname_to_conn_id = {}
+		self.conn_id_to_hostname = {} # the reverse of hostname_to_conn_id
+
+		# The first bytes object we received for each connection ID. Each received message has its own copy of the
+		# ID; swapping it for the pooled one means our dicts are always keyed and probed with the same object, whose
+		# hash is computed once and cached.
+		self.id_pool = {}
+
+		# A heap of (deadline, conn_id) entries, recording when each agent will be stale unless we hear from it again.
+		# Hearing from an agent pushes a new entry rather than updating its old one, so entries may be out of date --
+		# expire_agents() checks each entry against identities before acting on it.
+		self.expire_heap = []
 
 	def setup(self):
+		# message handlers, keyed by message header:
+		self.dispatch = {
+			MetricsMessage.header: self.on_metrics,
+			ControlMessage.header: self.on_control
+		}
 		self.server.on_recv(self.on_recv)
 
 	def on_recv(self, msg):
-		conn_id = msg[0]
-
-		# We record the datetime we last received a message from this agent:
-
-		self.identities[conn_id] = datetime.utcnow()
-
-		if msg[1] == MetricsMessage.header:
-
-			# We have received some kind of metrics message:
-
-			msg_obj = MetricsMessage.from_msg(msg[1:])
-			logging.debug("Received message from agent %s: %s" % (conn_id, msg[1:]))
-
-			# Here we deal with a scenario where a host disconnects, but then reconnects under a new connection ID.
-			# When we detect the same host on a new connection, then we will automatically expire the old connection.
-
-			if msg_obj.hostname in self.hostname_to_conn_id:
-				if self.hostname_to_conn_id[msg_obj.hostname] != conn_id:
-					# we are receiving data for this hostname from another connection -- maybe the previous connection
-					logging.debug("Receiving metrics data for %s on new connection" % msg_obj.hostname)
-					old_conn_id = self.hostname_to_conn_id[msg_obj.hostname]
-					if old_conn_id in self.identities:
-						del self.identities[old_conn_id]
-					self.hostname_to_conn_id[msg_obj.hostname] = conn_id
-			else:
-				# record a mapping of the agent's hostname to the connection ID.
-				self.hostname_to_conn_id[msg_obj.hostname] = conn_id
-
-			# If this is model data, we want to cache this information, since we send it to new agents when they
-			# connect:
-
-			if msg_obj.metrics_type == "model":
-				self.app.record_model_data(msg_obj)
-			else:
-				# metrics data.
-				if msg_obj.hostname not in self.app.model_data:
-					# It looks like we restarted but this agent's ZeroMQ stack automatically reconnected to us. But
-					# while we just received metrics data, we are missing the model data. So request it.
-					logging.info("We are missing model data for %s; requesting it." % msg_obj.hostname)
-					ControlMessage("model").send(self.server, identity=conn_id)
-
-			# But all metrics data, either 'model' or 'metrics' flavors, gets forwarded to all connected clients as we
-			# receive them. This way, connected clients will receive new 'model' messages for newly-connected agents,
-			# as well as periodic metrics from the agents:
-
-			self.app.relay_metrics_to_clients(msg_obj)
-
-		elif msg[1] == ControlMessage.header:
 
-			# We may also receive hello messages from agents when they initially connect to us.
-
-			msg_obj = ControlMessage.from_msg(msg[1:])
-			if msg_obj.message == "hello":
-				logging.debug("Received hello message from agent %s" % conn_id)
-				ControlMessage("model").send(self.server, identity=conn_id)
-			else:
-				logging.debug("Received %s message from agent %s" % msg_obj.message, conn_id)
+		# The ZMQStream hands us one message per ioloop callback. While we are here, we also drain any more messages
+		# that are already waiting on the socket, saving an ioloop dispatch for each of them. We stop after drain_limit
+		# of them, so that a busy agent socket can't starve the rest of the ioloop.
+
+		self.handle_msg(msg)
+		recv_multipart = self.server.socket.recv_multipart
+		for _ in range(self.drain_limit):
+			try:
+				msg = recv_multipart(zmq.NOBLOCK)
+			except zmq.Again:
+				break
+			self.handle_msg(msg)
+
+	def handle_msg(self, msg):
+		conn_id = self.id_pool.setdefault(msg[0], msg[0])
+
+		# We record the time (in time.monotonic() seconds) we last received a message from this agent, and when it will
+		# become stale. Agents can send us many messages a second, so we only update this once per touch_interval --
+		# far finer than our stale_interval needs:
+
+		now = time.monotonic()
+		last_seen = self.identities.get(conn_id)
+		if last_seen is None or now - last_seen >= self.touch_interval:
+			self.identities[conn_id] = now
+			heapq.heappush(self.expire_heap, (now + self.app.stale_interval, conn_id))
+
+		handler = self.dispatch.get(msg[1])
+		if handler is not None:
+			handler(conn_id, msg)
+
+	def on_metrics(self, conn_id, msg):
+
+		# We have received some kind of metrics message:
+
+		msg_obj = MetricsMessage.from_msg(msg[1:])
+		if logging.root.isEnabledFor(logging.DEBUG):
+			logging.debug("Received message from agent %s: %s", conn_id, msg[1:])
+
+		# Here we deal with a scenario where a host disconnects, but then reconnects under a new connection ID.
+		# When we detect the same host on a new connection, then we will automatically expire the old connection.
+
+		old_conn_id = self.hostname_to_conn_id.get(msg_obj.hostname)
+		if old_conn_id != conn_id:
+			if old_conn_id is not None:
+				# we are receiving data for this hostname from another connection -- maybe the previous connection
+				logging.debug("Receiving metrics data for %s on new connection", msg_obj.hostname)
+				if old_conn_id in self.identities:
+					del self.identities[old_conn_id]
+				self.id_pool.pop(old_conn_id, None)
+				self.conn_id_to_hostname.pop(old_conn_id, None)
+			# If this connection was reporting under another hostname, that hostname no longer maps to it -- the two
+			# maps always stay the exact reverse of each other:
+			old_hostname = self.conn_id_to_hostname.get(conn_id)
+			if old_hostname is not None:
+				del self.hostname_to_conn_id[old_hostname]
+			# record a mapping of the agent's hostname to the connection ID.
+			self.hostname_to_conn_id[msg_obj.hostname] = conn_id
+			self.conn_id_to_hostname[conn_id] = msg_obj.hostname
+
+		# If this is model data, we want to cache this information, since we send it to new agents when they
+		# connect:
+
+		if msg_obj.metrics_type == "model":
+			self.app.record_model_data(msg_obj)
+		else:
+			# metrics data.
+			if msg_obj.hostname not in self.app.model_data:
+				# It looks like we restarted but this agent's ZeroMQ stack automatically reconnected to us. But
+				# while we just received metrics data, we are missing the model data. So request it.
+				logging.info("We are missing model data for %s; requesting it.", msg_obj.hostname)
+				self.server.send_multipart([conn_id] + self.model_frames, copy=False)
+
+		# But all metrics data, either 'model' or 'metrics' flavors, gets forwarded to all connected clients as we
+		# receive them. This way, connected clients will receive new 'model' messages for newly-connected agents,
+		# as well as periodic metrics from the agents:
+
+		self.app.relay_metrics_to_clients(msg_obj)
+
+	def on_control(self, conn_id, msg):
+
+		# We may also receive hello messages from agents when they initially connect to us.
+
+		msg_obj = ControlMessage.from_msg(msg[1:])
+		if msg_obj.message == "hello":
+			logging.debug("Received hello message from agent %s", conn_id)
+			self.server.send_multipart([conn_id] + self.model_frames, copy=False)
+		else:
+			logging.debug("Received %s message from agent %s", msg_obj.message, conn_id)
+
+	def expire_agents(self, now):
+		"""Remove all agents we have not heard from in stale_interval, returning a list of the hostnames they were
+		reporting metrics for. Only the agents whose deadlines have passed are looked at."""
+		stale_interval = self.app.stale_interval
+		expired = []
+		while self.expire_heap and self.expire_heap[0][0] < now:
+			deadline, conn_id = heapq.heappop(self.expire_heap)
+			last_seen = self.identities.get(conn_id)
+			if last_seen is not None and now - last_seen > stale_interval:
+				logging.debug("Agent identity %s stale. Removing it.", conn_id)
+				hostname = self.remove_agent(conn_id)
+				if hostname is not None:
+					expired.append(hostname)
+		return expired
 
 	def remove_agent(self, agent_conn_id):
+		"""Forget an agent connection. Returns the hostname the agent was reporting metrics for, or None if it hadn't
+		sent us any metrics."""
 		del self.identities[agent_conn_id]
+		self.id_pool.pop(agent_conn_id, None)
+		hostname = self.conn_id_to_hostname.pop(agent_conn_id, None)
+		if hostname is not None:
+			del self.hostname_to_conn_id[hostname]
+		return hostname
 
-class CollectorClientRouterListener(RouterListener):
+class CollectorClientPubListener(RouterListener):
 
 	def __init__(self, app):
-		RouterListener.__init__(self, app=app, keyname="collector", bind_addr="tcp://127.0.0.1:5557", zap_auth=True)
+		RouterListener.__init__(self, app=app, keyname="collector", bind_addr="tcp://127.0.0.1:5557", zap_auth=True,
+		                        socket_type=zmq.XPUB)
 
-		self.identities = {}
-		self.identities_last_send = {}
+		self.last_send = 0.0 # when we last published anything, in time.monotonic() seconds
 
 	def setup(self):
+		# Tell us about every new subscription, not just the first one for each topic, so that we see every client that
+		# connects:
+		self.server.socket.setsockopt(zmq.XPUB_VERBOSE, 1)
 		self.server.on_recv(self.on_recv)
 
 	def on_recv(self, msg):
-		client_conn_id = msg[0]
-		self.identities[client_conn_id] = datetime.utcnow()
-		if msg[1] == ControlMessage.header:
-			msg_obj = ControlMessage.from_msg(msg[1:])
-			if msg_obj.message == "hello":
-				logging.info("Received 'hello' message from client %s" % client_conn_id)
-				if client_conn_id not in self.identities:
-					self.app.send_cached_model_data_to_client(client_conn_id)
+		# XPUB delivers subscriptions as a single frame: b"\x01" followed by the topic (unsubscriptions start with
+		# b"\x00".)
+		if msg[0][:1] == b"\x01":
+			logging.info("New client subscribed.")
+			self.app.send_cached_model_data_to_clients()
 
-
-	def remove_client(self, client_conn_id):
-		del self.identities[client_conn_id]
-		if client_conn_id in self.identities_last_send:
-				del self.identities_last_send[client_conn_id]
+	def publish(self, frames):
+		self.server.send_multipart(frames, copy=False)
+		self.last_send = time.monotonic()
 
 class AppCollector(object):
 
-	agent_ping_interval_ms = 5000
-	client_ping_interval_ms = 5000
-	stale_interval = timedelta(seconds=30)
-	ping_interval = timedelta(seconds=20)
-	ping = ControlMessage("ping")
-	model_data = {}
+	periodic_interval_ms = 5000
+	stale_interval = 30.0 # seconds -- keep this well over the agent's AppAgent.heartbeat_interval_s
+	ping_interval = 20.0 # seconds
+	relay_batch_size = 32
+	relay_delay_s = 0.01
+	ping_frames = ControlMessage("ping").to_frames()
 
 	def __init__(self, listen_ip):
 
+		# the most recent 'model' MetricsMessage from each connected agent, keyed by hostname:
+		self.model_data = {}
+
+		# metrics messages waiting to be relayed to clients, and the timeout that will relay them:
+		self.pending_relay = []
+		self.relay_timeout = None
+
 		self.listen_agents = CollectorMetricRouterListener(self, listen_ip)
-		self.listen_clients = CollectorClientRouterListener(self)
-		self.periodic_agent = PeriodicCallback(self.agent_ping, self.agent_ping_interval_ms)
-		self.periodic_client = PeriodicCallback(self.client_ping, self.client_ping_interval_ms)
+		self.listen_clients = CollectorClientPubListener(self)
+		self.periodic = PeriodicCallback(self.periodictask, self.periodic_interval_ms)
 
 	def record_model_data(self, msg_obj):
 
 		self.model_data[msg_obj.hostname] = msg_obj
 
-	def send_cached_model_data_to_client(self, client_conn_id):
+	def send_cached_model_data_to_clients(self):
 
 		"""
 		When a new client connects, we want to immediately send it all the 'model' info we have for all the
 		currently-connected agent systems. 'model' info is infreqently-changing information related to a host, such as
 		the amount of RAM installed -- stuff we don't expect to change very often. We will relay 'metrics' info --
-		rapidly changing data, like CPU usage -- in real-time as we get it. (but not in this method.)
-		:param client_conn_id: The connection id of the client who needs the cached model data.
+		rapidly changing data, like CPU usage -- in real-time as we get it. (but not in this method.) We can only
+		publish to all of our clients at once, so clients that are already connected will receive this data again.
 		:return: None
 		"""
 
-		for hostname, msg_obj in self.model_data.items():
-			# relay our received agent message to a client:
-			msg_obj.send(self.listen_clients.server, identity=client_conn_id)
-
-			# update our record of when we last sent data to this client:
-			self.listen_clients.identities_last_send[client_conn_id] = datetime.utcnow()
+		if self.model_data:
+			self.listen_clients.publish(MetricsBatchMessage(list(self.model_data.values())).to_frames())
 
 	def relay_metrics_to_clients(self, msg_obj):
 
 		"""
 		When new metric data is received from an agent -- this can be either 'model' data (from a new agent connection)
-		or periodic 'metric' data -- we want to forward this metric information to each client.
+		or periodic 'metric' data -- we want to forward this metric information to each client. The message is queued,
+		and relayed along with any others that arrive in the meantime by flush_relay().
 		:param msg_obj: The message object we received from the agent.
 		:return: None
 		"""
-		client_count = 0
-
-		for client_conn_id, client_last_recv in self.listen_clients.identities.items():
-			client_count += 1
-
-			# relay the message to this client:
-			msg_obj.send(self.listen_clients.server, identity=client_conn_id)
 
-			# update record of when we last sent data to this client:
-			self.listen_clients.identities_last_send[client_conn_id] = datetime.utcnow()
+		self.pending_relay.append(msg_obj)
+		if len(self.pending_relay) >= self.relay_batch_size:
+			self.flush_relay()
+		elif self.relay_timeout is None:
+			self.relay_timeout = IOLoop.current().call_later(self.relay_delay_s, self.flush_relay)
 
-		if client_count:
-			logging.debug("Relayed metrics to %s clients." % client_count)
-
-	def client_ping(self):
+	def flush_relay(self):
 
 		"""
-		This periodic task performs two functions -- first, it will look for any clients that we haven't heard from
-		in the last 30 seconds, and assume that they are stale connections, and remove them from our list of connected
-		clients.
-
-		The second thing we do here is to see if there are any clients to whom we have not sent any data recently,
-		and send them a 'hello' ControlMessage. Clients will expect to hear from us at least once every 30 seconds.
-		This scenario can occur when there are no connected agents and we have at least one connected client. We don't
-		want our lack of metrics data to indicate to the client that its connection is stale.
+		Publish all queued metrics messages to our clients as a single MetricsBatchMessage. One send reaches every
+		subscribed client (and costs next to nothing if there are none.)
 		:return: None
 		"""
 
-		utc_now = datetime.utcnow()
-
-		to_remove = []
-		client_count = 0
-
-		# Identify and remove any clients that appear to be dead. If we have not heard from them in 30 seconds, we
-		# want to remove them from our list of active clients.
-
-		for client_conn_id, client_last_recv in self.listen_clients.identities.items():
-			# Have we not heard from a client in a while? Consider it stale:
-			if (utc_now - client_last_recv) > self.stale_interval:
-				to_remove.append(client_conn_id)
-				client_count += 1
-			else:
-				# Have we not sent data to the client in a while? Send it a ping message:
-				if client_conn_id not in self.listen_clients.identities_last_send or \
-					(utc_now - self.listen_clients.identities_last_send[client_conn_id]) > self.ping_interval:
-					self.ping.send(self.listen_clients.server, identity=client_conn_id)
-					self.listen_clients.identities_last_send[client_conn_id] = utc_now
+		if self.relay_timeout is not None:
+			IOLoop.current().remove_timeout(self.relay_timeout)
+			self.relay_timeout = None
+		if self.pending_relay:
+			self.listen_clients.publish(MetricsBatchMessage(self.pending_relay).to_frames())
+			self.pending_relay = []
 
-		for client_conn_id in to_remove:
-			# we do this outside of the previous loop so we don't modify the dictionary while iterating over it:
-			self.listen_clients.remove_client(client_conn_id)
+	def periodictask(self):
 
-		if client_count:
-			logging.debug("Removed %s stale clients." % client_count)
+		# Our agent and client housekeeping run on the same schedule, so they share one timer and one clock reading:
 
-	def agent_ping(self):
+		now = time.monotonic()
+		self.agent_ping(now)
+		self.client_ping(now)
 
-		utc_now = datetime.utcnow()
-		to_remove = []
+	def client_ping(self, now):
 
-		# Periodically send "ping" message back to connected agents, or if we haven't seen them in a while, remove
-		# them from our list of active agents.
+		"""
+		This periodic task checks whether we have published anything to our clients recently, and if not, publishes a
+		'ping' ControlMessage. Clients will expect to hear from us at least once every 30 seconds. This scenario can
+		occur when there are no connected agents and we have at least one connected client. We don't want our lack of
+		metrics data to indicate to the client that its connection is stale.
+		:return: None
+		"""
 
-		for conn_id, last_seen in self.listen_agents.identities.items():
-			if (utc_now - last_seen) > self.stale_interval:
-				logging.debug("Agent identity %s stale. Adding to removal list." % conn_id)
-				to_remove.append(conn_id)
-			else:
-				self.ping.send(self.listen_agents.server, identity=conn_id)
+		if now - self.listen_clients.last_send > self.ping_interval:
+			self.listen_clients.publish(self.ping_frames)
 
-		if len(to_remove):
+	def agent_ping(self, now):
 
-			conn_id_to_hostname_map = dict((v, k) for k, v in self.listen_agents.hostname_to_conn_id.items())
+		# Periodically remove agents we haven't seen in a while from our list of active agents, and send a "ping"
+		# message back to the remaining connected agents.
 
-			for conn_id in to_remove:
-				if conn_id in conn_id_to_hostname_map:
-					hostname = conn_id_to_hostname_map[conn_id]
-					logging.debug("Removing %s from list of active agents." % hostname)
-					if hostname in self.model_data:
-						del self.model_data[hostname]
+		for hostname in self.listen_agents.expire_agents(now):
+			logging.debug("Removing %s from list of active agents.", hostname)
+			if hostname in self.model_data:
+				del self.model_data[hostname]
 
-				del self.listen_agents.identities[conn_id]
+		send_multipart = self.listen_agents.server.send_multipart
+		ping_frames = self.ping_frames
+		for conn_id in self.listen_agents.identities:
+			send_multipart([conn_id] + ping_frames, copy=False)
 
 	def start(self):
-		self.periodic_agent.start()
-		self.periodic_client.start()
+		self.periodic.start()
 		# call this last, because this call will block the main thread until interrupted:
-		start_ioloop()
+		try:
+			start_ioloop()
+		finally:
+			self.listen_clients.stop()
 
 
 if __name__ == "__main__":
@@ -6,13 +6,14 @@ import string
 import random
 from zmq.eventloop.ioloop import IOLoop, PeriodicCallback
 from zmq.eventloop.zmqstream import ZMQStream
-from zmq.auth.ioloop import IOLoopAuthenticator
+from zmq.auth.thread import ThreadAuthenticator
 from key_monkey import *
 from logging_settings import *
 
 class DealerConnection(object):
 
-	def __init__(self, app=None, keyname="client", remote_keyname="server", endpoint="tcp://127.0.0.1:5556", crypto=True):
+	def __init__(self, app=None, keyname="client", remote_keyname="server", endpoint="tcp://127.0.0.1:5556",
+	             crypto=True, socket_type=zmq.DEALER):
 
 		self.app = app
 		self.keyname = keyname
@@ -20,8 +21,8 @@ class DealerConnection(object):
 		self.endpoint = endpoint
 		self.crypto = crypto
 
-		self.ctx = zmq.Context()
-		self.client = self.ctx.socket(zmq.DEALER)
+		self.ctx = zmq.Context.instance()
+		self.client = self.ctx.socket(socket_type)
 		self.client.setsockopt(zmq.IDENTITY, (''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16)).encode("ascii"))
  )
 
@@ -30,16 +31,24 @@ class DealerConnection(object):
 			self.client = self.keymonkey.setupClient(self.client, self.endpoint, remote_keyname)
 
 		self.client.connect(self.endpoint)
-		logging.debug("Connecting to " + self.endpoint)
+		logging.debug("Connecting to %s", self.endpoint)
 		self.client = ZMQStream(self.client)
 		self.setup()
 
 	def setup(self):
 		pass
 
+	def reconnect(self):
+		"""Drop our connection to the endpoint, along with any messages still queued for it, and connect again. Our
+		socket, its identity and its CurveZMQ keys are all reused."""
+		self.client.socket.disconnect(self.endpoint)
+		self.client.socket.connect(self.endpoint)
+		logging.debug("Reconnecting to %s", self.endpoint)
+
 class RouterListener(object):
 
-	def __init__(self, app=None, keyname="server", bind_addr="tcp://127.0.0.1:5556", crypto=True, zap_auth=True):
+	def __init__(self, app=None, keyname="server", bind_addr="tcp://127.0.0.1:5556", crypto=True, zap_auth=True,
+	             socket_type=zmq.ROUTER):
 
 		self.app = app
 		self.keyname = keyname
@@ -47,30 +56,37 @@ class RouterListener(object):
 		self.crypto = crypto
 		self.zap_auth = zap_auth
 
-		self.ctx = zmq.Context()
+		# Sockets share the process-wide context (and its I/O thread), except for a listener that does ZAP
+		# authentication: a ZAP handler applies to every CurveZMQ server socket in its context, so that listener gets a
+		# context of its own to keep it from authenticating our other listeners' peers too.
+		if self.zap_auth:
+			self.ctx = zmq.Context()
+		else:
+			self.ctx = zmq.Context.instance()
 		self.loop = IOLoop.instance()
 		self.identities = {}
 
-		self.server = self.ctx.socket(zmq.ROUTER)
+		self.server = self.ctx.socket(socket_type)
 
 		if self.crypto:
 			self.keymonkey = KeyMonkey(self.keyname)
 			self.server = self.keymonkey.setupServer(self.server, self.bind_addr)
 
 		self.server.bind(self.bind_addr)
-		logging.debug("%s listening for new client connections at %s" % ( self.keyname, self.bind_addr))
+		logging.debug("%s listening for new client connections at %s", self.keyname, self.bind_addr)
 		self.server = ZMQStream(self.server)
 		# Setup ZAP:
 		if self.zap_auth:
 			if not self.crypto:
 				logging.fatal("ZAP requires CurveZMQ (crypto) to be enabled. Exiting.")
 				sys.exit(1)
-			self.auth = IOLoopAuthenticator(self.ctx)
-			logging.info("ZAP enabled. Authorizing clients in %s." % self.keymonkey.authorized_clients_dir)
+			# ZAP requests are answered from the authenticator's own thread, so client handshakes aren't held up behind
+			# whatever our ioloop happens to be doing:
+			self.auth = ThreadAuthenticator(self.ctx)
+			logging.info("ZAP enabled. Authorizing clients in %s.", self.keymonkey.authorized_clients_dir)
 			if not os.path.isdir(self.keymonkey.authorized_clients_dir):
-				logging.fatal("Directory not found: %s. Exiting." % self.keymonkey.authorized_clients_dir)
+				logging.fatal("Directory not found: %s. Exiting.", self.keymonkey.authorized_clients_dir)
 				sys.exit(1)
-			self.auth.configure_curve(domain='*', location=self.keymonkey.authorized_clients_dir)
 		self.setup()
 		self.start()
 
@@ -79,8 +95,28 @@ class RouterListener(object):
 
 	def start(self):
 		if self.zap_auth:
+			# A ThreadAuthenticator passes its configuration to its thread, so it can only be configured once started:
 			self.auth.start()
+			self.auth.configure_curve(domain='*', location=self.keymonkey.authorized_clients_dir)
+
+	def stop(self):
+		if self.zap_auth:
+			self.auth.stop()
+
+
+def send_now(stream, frames, copy=True):
+
+	"""Send frames on a ZMQStream's socket immediately if the socket can take them, rather than queueing them on the
+	stream and waiting for the ioloop to report the socket writable. If the send would block, or earlier messages are
+	still queued on the stream (and must go out first), the frames are queued on the stream as usual."""
 
+	if not stream.sending():
+		try:
+			stream.socket.send_multipart(frames, zmq.NOBLOCK, copy=copy)
+			return
+		except zmq.Again:
+			pass
+	stream.send_multipart(frames, copy=copy)
 
 def start_ioloop():
 	loop = IOLoop.current()
@@ -46,10 +46,10 @@ class KeyMonkey(object):
 			server.curve_publickey = foo
 			server.curve_secretkey = bar
 		except IOError:
-			logging.error("Couldn't load private key: %s" % self.private_key)
+			logging.error("Couldn't load private key: %s", self.private_key)
 			return None
 		server.curve_server = True
-		logging.debug("Set up server listening on %s using curve key '%s'." % (endpoint, self.myid))
+		logging.debug("Set up server listening on %s using curve key '%s'.", endpoint, self.myid)
 		return server
 
 	def setupClient(self, client, endpoint, servername):
@@ -58,7 +58,8 @@ class KeyMonkey(object):
 		client.curve_secretkey = bar
 		foo, _ = zmq.auth.load_certificate(self.curvedir + "/" + servername + ".key" )
 		client.curve_serverkey = foo
-		logging.debug("Set up client connecting to %s (key '%s') using curve key '%s'." % (endpoint, servername, self.myid))
+		logging.debug("Set up client connecting to %s (key '%s') using curve key '%s'.", endpoint, servername,
+		              self.myid)
 		return client
 		
 # vim: ts=4 sw=4 noet
@@ -2,31 +2,36 @@
 
 from collections import defaultdict
 from datetime import datetime
+import os
 import socket
+import sys
+
+
+# our fully-qualified hostname, looked up the first time a Host needs it:
+_HOSTNAME = None
 
 
 class Host(object):
 	# represents a single hostname for which we are collecting metrics
 
 	def __init__(self, hostname=None):
+		global _HOSTNAME
 		if hostname is None:
-			if socket.gethostname().find('.') >= 0:
-				self.hostname = socket.gethostname()
-			else:
-				self.hostname = socket.gethostbyaddr(socket.gethostname())[0]
+			if _HOSTNAME is None:
+				_HOSTNAME = socket.gethostname()
+				if _HOSTNAME.find('.') < 0:
+					# this may need a DNS lookup, so we only ever do it once:
+					_HOSTNAME = socket.getfqdn(_HOSTNAME)
+				_HOSTNAME = sys.intern(_HOSTNAME)
+			self.hostname = _HOSTNAME
 		else:
-			self.hostname = hostname
-
-	def get_file(self, filename):
-		try:
-			with open(filename, "r") as myf:
-				return myf.read()
-		except IOError:
-			return None
+			self.hostname = sys.intern(hostname)
 
 
 class Collector(object):
 
+	# how often the metrics from this collector are worth sampling:
+	interval_ms = 1000
 	metric_defs = []
 	host = Host()
 	metrics = {}
@@ -35,7 +40,36 @@ class Collector(object):
 		return self.metrics[key]
 
 
-class UptimeCollector(Collector):
+class ProcFileCollector(Collector):
+
+	# A collector that samples a single /proc file. We keep the file open and re-read it from offset 0 into a
+	# preallocated buffer on every sample. The buffer starts with a newline, so every line in it (including the first)
+	# can be located with a single buffer.find(b"\nKey:") rather than by splitting the file into lines.
+
+	proc_path = None
+	buf_size = 4096
+
+	def __init__(self):
+		self._fd = os.open(self.proc_path, os.O_RDONLY)
+		self._buf = bytearray(self.buf_size)
+		self._buf[0] = ord("\n")
+		self._view = memoryview(self._buf)[1:]
+
+	def read(self):
+		# returns the length of the valid data in self._buf, including our leading newline:
+		return os.preadv(self._fd, [self._view], 0) + 1
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+
+class UptimeCollector(ProcFileCollector):
+
+	proc_path = "/proc/uptime"
+	buf_size = 64
+	interval_ms = 30000
 
 	metric_defs = {
 		"metrics": {
@@ -44,14 +78,22 @@ class UptimeCollector(Collector):
 	}
 
 	def get_samples(self, metrics_type='metrics'):
-		upt_data = self.host.get_file("/proc/uptime")
+		length = self.read()
 		try:
-			yield "sys.uptime", float(upt_data.split()[0])
-		except (IndexError, ValueError):
+			# index() rather than find(), so that a missing space raises ValueError instead of giving us a bogus slice:
+			yield "sys.uptime", float(self._buf[1:self._buf.index(b" ", 1, length)])
+		except ValueError:
 			return
 
 
-class MeminfoCollector(Collector):
+class MeminfoCollector(ProcFileCollector):
+
+	proc_path = "/proc/meminfo"
+	buf_size = 8192
+	interval_ms = 5000
+
+	# Keys are listed in the order the kernel writes them to /proc/meminfo, which lets get_samples() find them all in a
+	# single forward pass:
 
 	metric_map = {
 		"metrics": {
@@ -59,9 +101,9 @@ class MeminfoCollector(Collector):
 			"MemAvailable": "mem.avail",
 			"Buffers": "mem.buffers",
 			"Cached": "mem.cached",
+			"SwapFree": "mem.swap.free",
 			"Dirty": "mem.dirty",
-			"Writeback": "mem.writeback",
-			"SwapFree": "mem.swap.free"
+			"Writeback": "mem.writeback"
 		},
 		"model": {
 			"MemTotal": "mem.total",
@@ -69,6 +111,16 @@ class MeminfoCollector(Collector):
 		}
 	}
 
+	# search strings for each /proc/meminfo line we want, built once from metric_map:
+
+	needles = {
+		metrics_type: [
+			(("\n%s:" % meminfo_key).encode("ascii"), metric_key)
+			for meminfo_key, metric_key in keys.items()
+		]
+		for metrics_type, keys in metric_map.items()
+	}
+
 	metric_defs = {
 		"metrics": {
 			"mem.free": {"desc": "Free memory", "units": "kB", "python_type": int},
@@ -87,53 +139,66 @@ class MeminfoCollector(Collector):
 
 	def get_samples(self, metrics_type="metrics"):
 
-		mem_data = self.host.get_file("/proc/meminfo")
-
-		for line in mem_data.split('\n'):
+		length = self.read()
+		buf = self._buf
+
+		# Each search starts where the previous line we wanted ended, so we only scan /proc/meminfo up to the last line
+		# we want, once. Should a kernel ever order these lines differently, we fall back to searching from the start.
+
+		pos = 0
+		for needle, metric_key in self.needles[metrics_type]:
+			start = buf.find(needle, pos, length)
+			if start < 0:
+				start = buf.find(needle, 0, pos)
+				if start < 0:
+					continue
+			start += len(needle)
+			end = buf.find(b" kB", start, length)
 			try:
-				line_split = line.split()
-				meminfo_key = line_split[0][:-1]
-				if len(line_split) and meminfo_key in self.metric_map[metrics_type].keys():
-					metric_key = self.metric_map[metrics_type][meminfo_key]
-					value = line_split[1]
-					yield metric_key, int(value)
-			except (IndexError, ValueError):
-				pass
+				yield metric_key, int(buf[start:end])
+			except ValueError:
+				continue
+			pos = end
 
 
-class CPUPercentCollector(Collector):
-	
+class CPUPercentCollector(ProcFileCollector):
+
+	proc_path = "/proc/stat"
+	buf_size = 256 # /proc/stat can be long, but we only ever want its first line
+	interval_ms = 1000
+
+	metric_defs = {
+		"metrics": {
+			"cpu.percent": {"desc": "CPU utilization, in hundredths of a percent", "units": "0.01%", "python_type": int}
+		}
+	}
+
 	def __init__(self):
+		ProcFileCollector.__init__(self)
 		# our algorithm uses a delta from a previous reading. Let's grab this:
 		self.prev = self.run()
 	
 	def run(self):
-		with open('/proc/stat', 'r') as f_stat:
-			while True:
-				line = f_stat.readline()
-				if line is None:
-					break
-				ls = line.split()
-				if len(ls) and ls[0] == 'cpu':
-					return list(map(int, ls[1:]))
+		"""Returns the (idle, total) CPU time counters from /proc/stat. Idle time includes iowait; the total is the
+		first eight fields -- user, nice, system, idle, iowait, irq, softirq and steal. The aggregate "cpu" line is
+		always the first line of /proc/stat, so that is all we read."""
+		length = self.read()
+		fields = list(map(int, self._buf[1:self._buf.find(b"\n", 1, length)].split()[1:9]))
+		return fields[3] + fields[4], sum(fields)
 	
 	def get_samples(self, metrics_type=None):
-		cur = self.run()
-		previdle = self.prev[3] + self.prev[4]
-		idle = cur[3] + cur[4]
-		
-		prevnonidle = self.prev[0] + self.prev[1] + self.prev[2] + self.prev[5] + self.prev[6] + self.prev[7]
-		nonidle = cur[0] + cur[1] + cur[2] + cur[5] + cur[6] + cur[7]
-		
-		prevtotal = previdle + prevnonidle
-		total = idle + nonidle
-		
+		idle, total = self.run()
+		previdle, prevtotal = self.prev
+		self.prev = idle, total
+
 		totald = total - prevtotal
 		idled = idle - previdle
-		
-		self.prev = cur
+
 		if totald == 0:
 			yield "cpu.percent", 0
 		else:
-			yield "cpu.percent", ((totald - idled) / totald) * 100
+			# hundredths of a percent is already far more precision than /proc/stat's tick counts give us. We report
+			# it as an integer number of hundredths (0-10000), which msgpack packs in at most 3 bytes, rather than as a
+			# float, which it always packs in 9:
+			yield "cpu.percent", int(round(((totald - idled) / totald) * 10000))
 	
\ No newline at end of file
@@ -6,6 +6,15 @@ class MultiPartMessage(object):
 
 	header = b"PING"
 
+	# Messages are created for every send and receive, so we don't give them an instance __dict__. Child classes
+	# should declare __slots__ for their own attributes, too.
+	__slots__ = ()
+
+	# Whether pyzmq should copy our frames into libzmq-owned buffers when sending. Our frames are immutable bytes
+	# objects, so by default libzmq sends straight from them instead. (pyzmq still copies frames that are smaller than
+	# zmq.COPY_THRESHOLD, where that is cheaper.)
+	copy_frames = False
+
 	"""In child classes, create an __init__ method that takes arguments containing message payload."""
 
 	@classmethod
@@ -17,12 +26,18 @@ class MultiPartMessage(object):
 	def msg(self):
 		return [self.header]
 
+	def to_frames(self):
+		"""Returns the list of frames that make up this message on the wire. For messages whose contents never change,
+		call this once and send the resulting frames directly."""
+		return self.msg
+
 	def send(self, socket, identity=None):
-		"""Send message to socket"""
-		msg = self.msg
+		"""Send message to socket. Uses to_frames(), so child classes that cache their wire frames are not re-encoded
+		for every socket or identity they are sent to."""
+		msg = self.to_frames()
 		if identity:
 			msg = [identity] + msg
-		socket.send_multipart(msg)
+		socket.send_multipart(msg, copy=self.copy_frames, track=False)
 
 	@classmethod
 	def from_msg(cls, msg):
@@ -1,12 +1,13 @@
 #!/usr/bin/python3
 
 from zmq_msg_core import *
-import json
+import msgpack
 
 
 class ControlMessage(MultiPartMessage):
 
 	header = b"CTRL"
+	__slots__ = ("message",)
 
 	def __init__(self, message):
 		self.message = message
@@ -16,7 +17,7 @@ class ControlMessage(MultiPartMessage):
 		return [ self.header, self.message.encode("utf-8") ]
 
 	def log(self):
-		logging.info("Sending ControlMessage: %s." % self.message)
+		logging.info("Sending ControlMessage: %s.", self.message)
 
 	@classmethod
 	def from_msg(cls, msg):
@@ -30,28 +31,83 @@ class ControlMessage(MultiPartMessage):
 class MetricsMessage(MultiPartMessage):
 
 	header = b"METR"
+	__slots__ = ("hostname", "grid_dict", "metrics_type", "hostname_bytes", "metrics_type_bytes", "_frames")
 
 	def __init__(self, hostname, grid_dict, metrics_type="metrics"):
 		self.hostname = hostname
 		self.grid_dict = grid_dict
 		self.metrics_type = metrics_type
+		# these never change once a message is created, so we only encode them once:
+		self.hostname_bytes = hostname.encode("utf-8")
+		self.metrics_type_bytes = metrics_type.encode("utf-8")
+		self._frames = None
 
 	@property
 	def msg(self):
-		return [self.header, self.hostname.encode("utf-8"), json.dumps(self.grid_dict).encode("utf-8"),
-			self.metrics_type.encode("utf-8") ]
+		return [self.header, self.hostname_bytes, msgpack.packb(self.grid_dict, use_bin_type=True),
+			self.metrics_type_bytes]
+
+	def to_frames(self):
+		"""Returns our wire frames, only serializing grid_dict the first time we are called -- so relaying one message
+		to many clients serializes it once. If grid_dict is modified in place afterwards, call changed() before sending
+		the message again."""
+		if self._frames is None:
+			self._frames = self.msg
+		return self._frames
+
+	def changed(self):
+		"""Discard our cached wire frames, because grid_dict has been modified."""
+		self._frames = None
 
 	def log(self):
-		logging.info("Sending MetricsMessage of type %s" % self.metrics_type)
+		logging.info("Sending MetricsMessage of type %s", self.metrics_type)
 
 	@classmethod
 	def from_msg(cls, msg):
 
-		"""Construct a MetricsMessage from a pyzmq message"""
+		"""Construct a MetricsMessage from a pyzmq message. The frames we were constructed from become our cached wire
+		frames, so relaying a received message sends the bytes we received rather than re-serializing them."""
 
 		if len(msg) != 4 or msg[0] != cls.header:
 			#invalid
 			return None
-		return cls(msg[1].decode("utf-8"), json.loads(msg[2].decode("utf-8")), msg[3].decode("utf-8"))
+		msg_obj = cls(msg[1].decode("utf-8"), msgpack.unpackb(msg[2], raw=False), msg[3].decode("utf-8"))
+		msg_obj._frames = list(msg)
+		return msg_obj
+
+
+class MetricsBatchMessage(MultiPartMessage):
+
+	"""A batch of MetricsMessages, sent as one multipart message: our header, followed by the hostname, payload and
+	metrics type frames of each MetricsMessage in turn."""
+
+	header = b"MBAT"
+	__slots__ = ("messages",)
+
+	def __init__(self, messages):
+		self.messages = messages
+
+	@property
+	def msg(self):
+		frames = [self.header]
+		for msg_obj in self.messages:
+			frames.extend(msg_obj.to_frames()[1:])
+		return frames
+
+	def log(self):
+		logging.info("Sending MetricsBatchMessage of %s messages", len(self.messages))
+
+	@classmethod
+	def from_msg(cls, msg):
+
+		"""Construct a MetricsBatchMessage from a pyzmq message"""
+
+		if len(msg) < 4 or (len(msg) - 1) % 3 or msg[0] != cls.header:
+			#invalid
+			return None
+		return cls([
+			MetricsMessage.from_msg([MetricsMessage.header] + msg[pos:pos + 3])
+			for pos in range(1, len(msg), 3)
+		])
 
 # vim: ts=4 sw=4 noet